@@ -6,9 +6,8 @@ Linux-specific filesystem functions."""
 #-
 
 import os
-import enum
 import ctypes as ct
-import atexit
+import functools
 
 #+
 # Useful stuff
@@ -84,18 +83,84 @@ class OPENAT2 :
 
 #end OPENAT2
 
+# valid keyword args for open_at()
+_OPEN_HOW_VALID = frozenset(f[0] for f in OPENAT2.open_how._fields_)
+_OPEN_HOW_SIZE = ct.sizeof(OPENAT2.open_how)
+
 libc.ioctl.argtypes = (ct.c_int, ct.c_ulong, ct.c_void_p)
 libc.ioctl.restype = ct.c_int
 libc.linkat.argtypes = (ct.c_int, ct.c_char_p, ct.c_int, ct.c_char_p, ct.c_int)
 libc.linkat.restype = ct.c_int
+# bound once here, to save attribute lookups on every call
+_ioctl = libc.ioctl
+_linkat = libc.linkat
+_get_errno = ct.get_errno
+_strerror = os.strerror
+
+# Not using def_syscall for this, so the syscall code can be passed without
+# going through a generic *args wrapper.
+_syscall_openat2 = make_funcptr(libc, "syscall")
+_syscall_openat2.argtypes = \
+    (ct.c_long, ct.c_int, ct.c_char_p, ct.POINTER(OPENAT2.open_how), ct.c_size_t)
+_syscall_openat2.restype = ct.c_long
+
+def openat2(dirfd, pathname, how, size) :
+    "direct wrapper around the openat2(2) syscall."
+    return \
+        _syscall_openat2(SYS.openat2, dirfd, pathname, how, size)
+#end openat2
+
+class FIEMAP :
+    "definitions from /usr/include/linux/fiemap.h."
+
+    class extent(ct.Structure) :
+        _fields_ = \
+            [
+                ("fe_logical", ct.c_uint64), # logical offset in bytes for the start of the extent
+                ("fe_physical", ct.c_uint64), # physical offset in bytes for the start of the extent
+                ("fe_length", ct.c_uint64), # length in bytes for the extent
+                ("fe_reserved64", 2 * ct.c_uint64),
+                ("fe_flags", ct.c_uint32), # EXTENT_xxx flags for this extent
+                ("fe_reserved", 3 * ct.c_uint32),
+            ]
+    #end extent
 
-openat2 = def_syscall \
-  (
-    "openat2",
-    SYS.openat2,
-    (ct.c_int, ct.c_char_p, ct.POINTER(OPENAT2.open_how), ct.c_size_t),
-    ct.c_long
-  )
+    class fiemap(ct.Structure) :
+        # header only; the kernel fills in an array of fm_extent_count
+        # extent structs immediately following this.
+        _fields_ = \
+            [
+                ("fm_start", ct.c_uint64), # logical offset (inclusive) at which to start mapping (in)
+                ("fm_length", ct.c_uint64), # logical length of mapping which userspace wants (in)
+                ("fm_flags", ct.c_uint32), # FLAG_xxx flags for request (in/out)
+                ("fm_mapped_extents", ct.c_uint32), # number of extents that were mapped (out)
+                ("fm_extent_count", ct.c_uint32), # size of fm_extents array (in)
+                ("fm_reserved", ct.c_uint32),
+            ]
+    #end fiemap
+
+    MAX_OFFSET = 0xFFFFFFFFFFFFFFFF
+
+    # bits for fiemap.fm_flags
+    FLAG_SYNC = 0x00000001 # sync file data before map
+    FLAG_XATTR = 0x00000002 # map extended attribute tree
+    FLAG_CACHE = 0x00000004 # request caching of the extents
+    FLAGS_COMPAT = FLAG_SYNC | FLAG_XATTR
+
+    # bits for extent.fe_flags
+    EXTENT_LAST = 0x00000001 # last extent in file
+    EXTENT_UNKNOWN = 0x00000002 # data location unknown
+    EXTENT_DELALLOC = 0x00000004 # location still pending
+    EXTENT_ENCODED = 0x00000008 # data can not be read while fs is unmounted
+    EXTENT_DATA_ENCRYPTED = 0x00000080 # data is encrypted by fs
+    EXTENT_NOT_ALIGNED = 0x00000100 # extent offsets may not be block aligned
+    EXTENT_DATA_INLINE = 0x00000200 # data mixed with metadata
+    EXTENT_DATA_TAIL = 0x00000400 # multiple files in block
+    EXTENT_UNWRITTEN = 0x00000800 # space allocated, but no data (i.e. zero)
+    EXTENT_MERGED = 0x00001000 # file does not natively support extents; result merged for efficiency
+    EXTENT_SHARED = 0x00002000 # space shared with other files
+
+#end FIEMAP
 
 class _IOC :
     # from </usr/include/asm-generic/ioctl.h>
@@ -118,44 +183,102 @@ class _IOC :
     NONE = 0 # note -- architecture-specific!
     WRITE = 1 # note -- architecture-specific!
     READ = 2 # note -- architecture-specific!
-    TYPECHECK = lambda t : \
-        (
-            (
-                lambda : ct.sizeof(t),
-                lambda : t,
-            )[isinstance(t, int)]()
-        )
+    @staticmethod
+    def TYPECHECK(t) :
+        return \
+            (t if isinstance(t, int) else ct.sizeof(t))
+    #end TYPECHECK
 
     # for decoding codes constructed by _IOC() and derivatives:
-    DIR = lambda nr : nr >> DIRSHIFT & DIRMASK
-    TYPE = lambda nr : nr >> TYPESHIFT & TYPEMASK
-    NR = lambda nr : nr >> NRSHIFT & NRMASK
-    SIZE = lambda nr : nr >> SIZESHIFT & SIZEMASK
+
+    @staticmethod
+    def DIR(nr) :
+        return \
+            nr >> _IOC.DIRSHIFT & _IOC.DIRMASK
+    #end DIR
+
+    @staticmethod
+    def TYPE(nr) :
+        return \
+            nr >> _IOC.TYPESHIFT & _IOC.TYPEMASK
+    #end TYPE
+
+    @staticmethod
+    def NR(nr) :
+        return \
+            nr >> _IOC.NRSHIFT & _IOC.NRMASK
+    #end NR
+
+    @staticmethod
+    def SIZE(nr) :
+        return \
+            nr >> _IOC.SIZESHIFT & _IOC.SIZEMASK
+    #end SIZE
+
+    # IOC() is memoized, since the same codes tend to be constructed
+    # repeatedly. Its args are all ints or single-character strs; the
+    # wrappers below resolve struct sizes before calling it.
+
+    @staticmethod
+    @functools.lru_cache(maxsize = 256)
+    def IOC(dir, type, nr, size) :
+        if type.__class__ is str :
+            type = ord(type)
+        #end if
+        return \
+            dir << _DS | type << _TS | nr << _NS | size << _SS
+    #end IOC
+
+    # convenience wrappers around IOC():
+
+    @staticmethod
+    def IO(type, nr) :
+        return \
+            _IOC.IOC(_IOC.NONE, type, nr, 0)
+    #end IO
+
+    @staticmethod
+    def IOR(type, nr, size) :
+        return \
+            _IOC.IOC(_IOC.READ, type, nr, _IOC.TYPECHECK(size))
+    #end IOR
+
+    @staticmethod
+    def IOW(type, nr, size) :
+        return \
+            _IOC.IOC(_IOC.WRITE, type, nr, _IOC.TYPECHECK(size))
+    #end IOW
+
+    @staticmethod
+    def IOWR(type, nr, size) :
+        return \
+            _IOC.IOC(_IOC.READ | _IOC.WRITE, type, nr, _IOC.TYPECHECK(size))
+    #end IOWR
+
+    @staticmethod
+    def IOR_BAD(type, nr, size) :
+        return \
+            _IOC.IOC(_IOC.READ, type, nr, ct.sizeof(size))
+    #end IOR_BAD
+
+    @staticmethod
+    def IOW_BAD(type, nr, size) :
+        return \
+            _IOC.IOC(_IOC.WRITE, type, nr, ct.sizeof(size))
+    #end IOW_BAD
+
+    @staticmethod
+    def IOWR_BAD(type, nr, size) :
+        return \
+            _IOC.IOC(_IOC.READ | _IOC.WRITE, type, nr, ct.sizeof(size))
+    #end IOWR_BAD
 
 #end _IOC
-_IOC.IOC = lambda dir, type, nr, size : \
-    (
-        dir << _IOC.DIRSHIFT
-    |
-            (
-                lambda : type,
-                lambda : ord(type),
-            )[isinstance(type, str)]()
-        <<
-            _IOC.TYPESHIFT
-    |
-        nr << _IOC.NRSHIFT
-    |
-        size << _IOC.SIZESHIFT
-    )
-# convenience wrappers around IOC():
-_IOC.IO = lambda type, nr : _IOC.IOC(_IOC.NONE, type, nr, 0)
-_IOC.IOR = lambda type, nr, size : _IOC.IOC(_IOC.READ, type, nr, _IOC.TYPECHECK(size))
-_IOC.IOW = lambda type, nr, size : _IOC.IOC(_IOC.WRITE, type, nr, _IOC.TYPECHECK(size))
-_IOC.IOWR = lambda type, nr, size : _IOC.IOC(_IOC.READ | _IOC.WRITE, type, nr, _IOC.TYPECHECK(size))
-_IOC.IOR_BAD = lambda type, nr, size : _IOC.IOC(_IOC.READ, type, nr, ct.sizeof(size))
-_IOC.IOW_BAD = lambda type, nr, size : _IOC.IOC(_IOC.WRITE, type, nr, ct.sizeof(size))
-_IOC.IOWR_BAD = lambda type, nr, size : _IOC.IOC(_IOC.READ | _IOC.WRITE, type, nr, sizeof(size))
+# shift amounts as globals, to save attribute lookups in _IOC.IOC():
+_DS = _IOC.DIRSHIFT
+_TS = _IOC.TYPESHIFT
+_NS = _IOC.NRSHIFT
+_SS = _IOC.SIZESHIFT
 
 class FS :
     "definitions of codes and flag bits that you will need."
@@ -177,9 +300,7 @@ class FS :
         def copy(self) :
             celf = type(self)
             res = celf()
-            for f in celf._fields_ :
-                setattr(res, f[0], getattr(self, f[0]))
-            #end for
+            ct.memmove(ct.addressof(res), ct.addressof(self), ct.sizeof(celf))
             return \
                 res
         #end copy
@@ -187,16 +308,11 @@ class FS :
         def __repr__(self) :
             return \
                 (
-                    "(%s)"
-                %
-                    ", ".join
-                      (
-                            "%%s = %s" % ("%d", "%#0.8x")[f == "fsx_xflags"]
-                        %
-                            (f, getattr(self, f))
-                        for f in
-                            ("fsx_xflags", "fsx_extsize", "fsx_nextents", "fsx_projid", "fsx_cowextsize")
-                      )
+                    f"(fsx_xflags = 0x{self.fsx_xflags:08x},"
+                    f" fsx_extsize = {self.fsx_extsize},"
+                    f" fsx_nextents = {self.fsx_nextents},"
+                    f" fsx_projid = {self.fsx_projid},"
+                    f" fsx_cowextsize = {self.fsx_cowextsize})"
                 )
         #end __repr__
 
@@ -222,19 +338,21 @@ class FS :
 
     FSLABEL_MAX = 256
 
+    # Precomputed ioctl codes, with the expressions they come from. Those
+    # involving a long depend on its size, so only those are still computed.
     IOC_GETFLAGS = _IOC.IOR('f', 1, ct.c_long)
     IOC_SETFLAGS = _IOC.IOW('f', 2, ct.c_long)
     IOC_GETVERSION = _IOC.IOR('v', 1, ct.c_long)
     IOC_SETVERSION = _IOC.IOW('v', 2, ct.c_long)
-    # IOC_FIEMAP = _IOC.IOWR('f', 11, struct fiemap) # from </usr/include/linux/fiemap.h>
-    IOC32_GETFLAGS = _IOC.IOR('f', 1, ct.c_int)
-    IOC32_SETFLAGS = _IOC.IOW('f', 2, ct.c_int)
-    IOC32_GETVERSION = _IOC.IOR('v', 1, ct.c_int)
-    IOC32_SETVERSION = _IOC.IOW('v', 2, ct.c_int)
-    IOC_FSGETXATTR = _IOC.IOR('X', 31, xattr)
-    IOC_FSSETXATTR = _IOC.IOW('X', 32, xattr)
-    IOC_GETFSLABEL = _IOC.IOR(0x94, 49, FSLABEL_MAX)
-    IOC_SETFSLABEL = _IOC.IOW(0x94, 50, FSLABEL_MAX)
+    IOC_FIEMAP = 0xc020660b # _IOC.IOWR('f', 11, FIEMAP.fiemap)
+    IOC32_GETFLAGS = 0x80046601 # _IOC.IOR('f', 1, ct.c_int)
+    IOC32_SETFLAGS = 0x40046602 # _IOC.IOW('f', 2, ct.c_int)
+    IOC32_GETVERSION = 0x80047601 # _IOC.IOR('v', 1, ct.c_int)
+    IOC32_SETVERSION = 0x40047602 # _IOC.IOW('v', 2, ct.c_int)
+    IOC_FSGETXATTR = 0x801c581f # _IOC.IOR('X', 31, xattr)
+    IOC_FSSETXATTR = 0x401c5820 # _IOC.IOW('X', 32, xattr)
+    IOC_GETFSLABEL = 0x81009431 # _IOC.IOR(0x94, 49, FSLABEL_MAX)
+    IOC_SETFSLABEL = 0x41009432 # _IOC.IOW(0x94, 50, FSLABEL_MAX)
 
     # see ioctl_iflags(2) man page for info about these
     SECRM_FL = 0x00000001
@@ -273,6 +391,19 @@ class FS :
 
 #end FS
 
+# valid keyword args for setfsxattr()
+_XATTR_VALID = frozenset(f[0] for f in FS.xattr._fields_ if f[0] != "fsx_pad")
+
+# ioctl(2) entry points with exact argument types for each kind of request.
+# Since the third arg is declared as a pointer to the right type, callers
+# can pass the buffer object directly, without wrapping it in ct.byref().
+_ioctl_long = make_funcptr(libc, "ioctl")
+_ioctl_long.argtypes = (ct.c_int, ct.c_ulong, ct.POINTER(ct.c_long))
+_ioctl_long.restype = ct.c_int
+_ioctl_xattr = make_funcptr(libc, "ioctl")
+_ioctl_xattr.argtypes = (ct.c_int, ct.c_ulong, ct.POINTER(FS.xattr))
+_ioctl_xattr.restype = ct.c_int
+
 #+
 # Higher-level stuff
 #-
@@ -281,10 +412,11 @@ def _get_fileno(fd, argname = "fd") :
     # common code to allow caller to pass either an integer file
     # descriptor or an object with the usual Python fileno() method
     # that returns such a file descriptor.
-    if not isinstance(fd, int) :
-        if hasattr(fd, "fileno") :
-            fd = fd.fileno()
-        else :
+    if fd.__class__ is not int :
+        fileno = getattr(fd, "fileno", None)
+        if fileno is not None :
+            fd = fileno()
+        elif not isinstance(fd, int) :
             raise TypeError("%s arg must be int fileno or object with fileno() method" % argname)
         #end if
     #end if
@@ -292,33 +424,77 @@ def _get_fileno(fd, argname = "fd") :
         fd
 #end _get_fileno
 
-def _check_sts(sts) :
+def _get_path(pathname, argname) :
+    # common code to allow caller to pass a pathname as either a string,
+    # bytes or path-like object. Strings are encoded the same way
+    # the standard Python library does for filesystem calls.
+    try :
+        pathname = os.fsencode(pathname)
+    except TypeError :
+        raise TypeError("%s must be string or bytes" % argname) from None
+    #end try
+    return \
+        pathname
+#end _get_path
+
+def _check_sts(sts, _get_errno = _get_errno, _strerror = _strerror) :
     if sts < 0 :
-        errno = ct.get_errno()
-        raise OSError(errno, os.strerror(errno))
+        errno = _get_errno()
+        raise OSError(errno, _strerror(errno))
     #end if
 #end _check_sts
 
 def getflags(fd) :
     flags = ct.c_long()
-    _check_sts(libc.ioctl(_get_fileno(fd), FS.IOC_GETFLAGS, ct.byref(flags)))
+    _check_sts(_ioctl_long(_get_fileno(fd), FS.IOC_GETFLAGS, flags))
     return \
         flags.value
 #end getflags
 
+def getflags_many(fds) :
+    "returns a list of the flags for each of the sequence of fds. This is" \
+    " equivalent to [getflags(fd) for fd in fds], but with less per-fd" \
+    " overhead, for use when scanning many files."
+    ioctl = _ioctl_long
+    code = FS.IOC_GETFLAGS
+    flags = ct.c_long()
+    result = []
+    for fd in fds :
+        _check_sts(ioctl(_get_fileno(fd), code, flags))
+        result.append(flags.value)
+    #end for
+    return \
+        result
+#end getflags_many
+
 def setflags(fd, flags) :
     c_flags = ct.c_long(flags)
-    _check_sts(libc.ioctl(_get_fileno(fd), FS.IOC_SETFLAGS, ct.byref(c_flags)))
+    _check_sts(_ioctl_long(_get_fileno(fd), FS.IOC_SETFLAGS, c_flags))
 #end setflags
 
 def getfsxattr(fd) :
     "returns the fsx_ attribute flags as found in </usr/include/linux/fs.h>."
     xattr = FS.xattr()
-    _check_sts(libc.ioctl(_get_fileno(fd), FS.IOC_FSGETXATTR, ct.byref(xattr)))
+    _check_sts(_ioctl_xattr(_get_fileno(fd), FS.IOC_FSGETXATTR, xattr))
     return \
         xattr
 #end getfsxattr
 
+def getfsxattr_many(fds) :
+    "returns an array of FS.xattr structs, one for each of the sequence of fds." \
+    " This is equivalent to [getfsxattr(fd) for fd in fds], but with less" \
+    " per-fd overhead, for use when scanning many files."
+    fds = tuple(fds)
+    ioctl = _ioctl_xattr
+    code = FS.IOC_FSGETXATTR
+    result = (FS.xattr * len(fds))()
+    for i, fd in enumerate(fds) :
+        _check_sts(ioctl(_get_fileno(fd), code, result[i]))
+    #end for
+    return \
+        result
+#end getfsxattr_many
+
 def setfsxattr(fd, *args, **kwargs) :
     "sets new values for the fsx_ attribute flags as found in" \
     " </usr/include/linux/fs.h>. Call this as follows:\n" \
@@ -354,37 +530,89 @@ def setfsxattr(fd, *args, **kwargs) :
           )
     #end if
     if len(kwargs) > 0 :
-        valid = set(f[0] for f in FS.xattr._fields_ if f[0] != "fsx_pad")
         for field in kwargs :
-            if field not in valid :
+            if field not in _XATTR_VALID :
                 raise TypeError("invalid FS.xattr keyword %s" % field)
             #end if
             setattr(xattr, field, kwargs[field])
         #end for
     #end if
-    _check_sts(libc.ioctl(_get_fileno(fd), FS.IOC_FSSETXATTR, ct.byref(xattr)))
+    _check_sts(_ioctl_xattr(_get_fileno(fd), FS.IOC_FSSETXATTR, xattr))
 #end setfsxattr
 
+def _def_setfsxattr_field(field) :
+    # creates a function for the common case of changing just one field
+    # in an existing FS.xattr struct, bypassing the generic keyword
+    # handling in setfsxattr().
+
+    def setit(fd, xattr, value) :
+        setattr(xattr, field, value)
+        _check_sts(_ioctl_xattr(_get_fileno(fd), FS.IOC_FSSETXATTR, xattr))
+    #end setit
+
+#begin _def_setfsxattr_field
+    setit.__name__ = "setfsxattr_" + field[4:]
+    setit.__doc__ = \
+        (
+            "sets the %s field of FS.xattr struct xattr to value, and applies it"
+            " to fd. Equivalent to setfsxattr(fd, xattr) after doing that; typical"
+            " use is %s(fd, getfsxattr(fd), value)."
+        %
+            (field, setit.__name__)
+        )
+    return \
+        setit
+#end _def_setfsxattr_field
+
+setfsxattr_xflags = _def_setfsxattr_field("fsx_xflags")
+setfsxattr_extsize = _def_setfsxattr_field("fsx_extsize")
+setfsxattr_projid = _def_setfsxattr_field("fsx_projid")
+setfsxattr_cowextsize = _def_setfsxattr_field("fsx_cowextsize")
+
+def getfiemap(fd, start = 0, length = FIEMAP.MAX_OFFSET, flags = 0) :
+    "returns an array of FIEMAP.extent structs describing the physical layout" \
+    " of the given byte range of the file (default all of it), as returned by" \
+    " the FS_IOC_FIEMAP ioctl. flags is a combination of FIEMAP.FLAG_xxx bits." \
+    " The array is the buffer the kernel filled in, so it supports the buffer" \
+    " protocol for bulk access without per-extent conversion. Note the extents" \
+    " are counted first, then fetched; if the file gains extents in between," \
+    " the result is cut short, and its last extent will not have the" \
+    " FIEMAP.EXTENT_LAST flag set, so check for that if it matters."
+    fd = _get_fileno(fd)
+    hdr_size = ct.sizeof(FIEMAP.fiemap)
+    nr_extents = 0
+    while True :
+        # first pass asks only for the number of extents, second pass
+        # retrieves them into a buffer of the right size
+        buf = (ct.c_ubyte * (hdr_size + nr_extents * ct.sizeof(FIEMAP.extent)))()
+        hdr = FIEMAP.fiemap.from_buffer(buf)
+        hdr.fm_start = start
+        hdr.fm_length = length
+        hdr.fm_flags = flags
+        hdr.fm_extent_count = nr_extents
+        _check_sts(_ioctl(fd, FS.IOC_FIEMAP, buf))
+        if nr_extents != 0 or hdr.fm_mapped_extents == 0 :
+            break
+        #end if
+        nr_extents = hdr.fm_mapped_extents
+    #end while
+    return \
+        (FIEMAP.extent * hdr.fm_mapped_extents).from_buffer(buf, hdr_size)
+#end getfiemap
+
 def open_at(dirfd, pathname, **kwargs) :
     "convenient wrapper around openat2(2) which breaks out fields of open_how" \
     " struct into separate keyword args (flags, mode, resolve). Returns open" \
     " file descriptor on success."
-    if isinstance(pathname, str) :
-        c_pathname = pathname.encode()
-    elif not isinstance(pathname, (bytes, bytearray)) :
-        raise TypeError("pathname must be string or bytes")
-    else :
-        c_pathname = pathname
-    #end if
+    c_pathname = _get_path(pathname, "pathname")
     how = OPENAT2.open_how()
-    valid = set(f[0] for f in OPENAT2.open_how._fields_)
     for field in kwargs :
-        if field not in valid :
+        if field not in _OPEN_HOW_VALID :
             raise TypeError("invalid OPENAT2 keyword %s" % field)
         #end if
         setattr(how, field, kwargs[field])
     #end for
-    res = openat2(_get_fileno(dirfd, "dirfd"), c_pathname, ct.byref(how), ct.sizeof(how))
+    res = openat2(_get_fileno(dirfd, "dirfd"), c_pathname, how, _OPEN_HOW_SIZE)
     _check_sts(res)
     return \
         res
@@ -395,19 +623,8 @@ def save_tmpfile(fd, path) :
     " gives it the explicit name path, which must be on the same filesystem" \
     " where it was originally created. This is done following the procedure given" \
     " on the openat(2) man page."
-    if not isinstance(fd, int) :
-        if not hasattr(fd, "fileno") :
-            raise TypeError("fd must be an integer file descriptor or object with fileno() method")
-        #end if
-        fd = fd.fileno()
-    #end if
-    if isinstance(path, str) :
-        c_path = path.encode()
-    elif not isinstance(path, (bytes, bytearray)) :
-        raise TypeError("path must be string or bytes")
-    else :
-        c_path = path
-    #end if
-    tmpfile_path = "/proc/self/fd/%d" % fd # “magic symlink” to name of file with no name
-    _check_sts(libc.linkat(AT_FDCWD, tmpfile_path.encode(), AT_FDCWD, c_path, AT_SYMLINK_FOLLOW))
+    fd = _get_fileno(fd)
+    c_path = _get_path(path, "path")
+    tmpfile_path = b"/proc/self/fd/%d" % fd # “magic symlink” to name of file with no name
+    _check_sts(_linkat(AT_FDCWD, tmpfile_path, AT_FDCWD, c_path, AT_SYMLINK_FOLLOW))
 #end save_tmpfile